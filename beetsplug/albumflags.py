@@ -3,20 +3,31 @@ from beets import ui
 from beets.ui.commands import _do_query
 from beets.util import displayable_path
 
-from functools import reduce
+from itertools import groupby
+from operator import attrgetter
 import re
 
 
 class Flag:
     """An abstract object representing a flag that can be present on an ablum.
-    A flag should know how to remove itself from an album string and how to
+    A flag should know how to match itself in an album string and how to
     analyze an item to detect if the flag should be active.
     """
 
     _patterns = []
+    # Item attributes and optional fields the flag is generated from
+    _attrs = ()
+    _fields = ()
 
-    def remove(self, album):
-        return re.sub("|".join(self._patterns), "", album)
+    def _removal_patterns(self):
+        """Return the regex patterns matching this flag in an album string"""
+        return self._patterns
+
+    def _removal_literals(self):
+        """Return the literal strings of this flag in an album string, or None
+        if the flag can only be matched with a regex.
+        """
+        return None
 
     def generate(self, item):
         return ""
@@ -24,55 +35,78 @@ class Flag:
 
 class FieldMappingFlag(Flag):
     def _is_regex(self, string):
-        return re.match("^/.*/$", string)
+        return len(string) > 1 and string[0] == string[-1] == "/"
 
     def __init__(self, field, mapping):
         self._field = field
+        self._fields = (field,)
         self._mapping = mapping
 
-        self._string_mapping = dict(
-            filter(lambda it: not self._is_regex(it[0]), self._mapping.items())
-        )
-        self._regex_mapping = dict(
-            map(
-                lambda it: (it[0][1:-1], it[1]),
-                filter(lambda it: self._is_regex(it[0]), self._mapping.items()),
-            )
-        )
-
-    def remove(self, album):
-        patterns = map(lambda m: r" \(%s\)" % m, self._mapping.values())
-        return re.sub("|".join(patterns), "", album)
+        self._string_mapping = {}
+        self._regex_mapping = {}
+        for k, v in self._mapping.items():
+            if self._is_regex(k):
+                self._regex_mapping[k[1:-1]] = v
+            else:
+                self._string_mapping[k] = v
+
+        # Formatted flags for the plain string keys, the common case
+        self._string_flags = {
+            k: " (%s)" % v if v else "" for k, v in self._string_mapping.items()
+        }
+
+        # Compiled on first use so a broken key only fails when matching
+        self._regex_table = None
+
+    def _removal_patterns(self):
+        return [re.escape(m) for m in self._removal_literals()]
+
+    def _removal_literals(self):
+        return [" (%s)" % m for m in self._mapping.values()]
+
+    def _compile_regex_mapping(self):
+        table = []
+        for k, v in self._regex_mapping.items():
+            try:
+                table.append((re.compile(k), v))
+            except re.error as e:
+                raise ui.UserError(
+                    'invalid regex "/%s/" in albumflags field flag "%s": %s'
+                    % (k, self._field, e)
+                )
+        return table
 
     def _match(self, value):
         if value in self._string_mapping:
             return self._string_mapping[value]
         else:
-            return next(
-                (v for k, v in self._regex_mapping.items() if re.match(k, value)),
-                None,
-            )
+            if self._regex_table is None:
+                self._regex_table = self._compile_regex_mapping()
+            return next((v for k, v in self._regex_table if k.match(value)), None)
 
     def _format_flag(self, value):
+        if value in self._string_flags:
+            return self._string_flags[value]
         flag = self._match(value)
         return " (%s)" % flag if flag else ""
 
     def generate(self, item):
         if self._field in item:
             field_value = item[self._field]
-            values = (
-                field_value.split("; ") if isinstance(field_value, str) else field_value
-            )
-            flags = map(
-                self._format_flag,
-                values,
-            )
-            return "".join(flags)
+            if isinstance(field_value, str):
+                # Most fields hold a single value, only split multi-value ones
+                if "; " not in field_value:
+                    return self._format_flag(field_value)
+                values = field_value.split("; ")
+            else:
+                values = field_value
+            return "".join(map(self._format_flag, values))
         else:
             return ""
 
 
 class BitdepthFlag(Flag):
+    _attrs = ("bitdepth",)
     _patterns = [
         r" \(\d+bit\)",
     ]
@@ -88,6 +122,7 @@ class BitdepthFlag(Flag):
 
 
 class SamplerateFlag(Flag):
+    _attrs = ("samplerate",)
     _patterns = [
         r" \(\d+(\.\d+)?kHz\)",
     ]
@@ -103,10 +138,14 @@ class SamplerateFlag(Flag):
 
 
 class ChannelsFlag(Flag):
+    _attrs = ("channels",)
     _patterns = [
-        r" \(5.1\)",
+        r" \(5\.1\)",
     ]
 
+    def _removal_literals(self):
+        return [" (5.1)"]
+
     def generate(self, item):
         if item.channels == 6:
             return " (5.1)"
@@ -119,6 +158,7 @@ class AlbumFlags(BeetsPlugin):
         super(AlbumFlags, self).__init__()
 
         self._flags = []
+        self._flag_cache = {}
 
         self.config.add(
             {
@@ -150,18 +190,61 @@ class AlbumFlags(BeetsPlugin):
             elif category == "channels":
                 self._flags.append(ChannelsFlag())
 
+        # Drop flags configured more than once, they would only be repeated
+        unique_flags = {}
+        for flag in self._flags:
+            unique_flags.setdefault((type(flag), getattr(flag, "_field", None)), flag)
+        self._flags = list(unique_flags.values())
+
+        # Compiled on first use, beets loads plugins for every command
+        self._remove_re = None
+
+        # When no flag needs a regex, a chain of str.replace is enough
+        literals = [flag._removal_literals() for flag in self._flags]
+        self._remove_literals = (
+            [literal for flag_literals in literals for literal in flag_literals]
+            if None not in literals
+            else None
+        )
+
+        attrs = sorted({a for flag in self._flags for a in flag._attrs})
+        self._get_cache_attrs = attrgetter(*attrs) if attrs else lambda item: ()
+        self._cache_fields = [f for flag in self._flags for f in flag._fields]
+
         if self.config["auto"].get():
             self.import_stages = [self._import_stage]
 
     def _remove_flag_string(self, album):
         """Remove all known flags from the provided album string"""
-        return reduce(
-            lambda new_album, flag: flag.remove(new_album), self._flags, album
-        )
+        # Every flag is wrapped in parentheses
+        if "(" not in album:
+            return album
+        if self._remove_literals is not None:
+            for literal in self._remove_literals:
+                album = album.replace(literal, "")
+            return album
+        if self._remove_re is None:
+            self._remove_re = re.compile(
+                "|".join(p for flag in self._flags for p in flag._removal_patterns())
+            )
+        return self._remove_re.sub("", album)
 
     def _generate_flag_string(self, item):
-        """Generate a string with flags based on the items properties"""
-        return "".join(flag.generate(item) for flag in self._flags)
+        """Generate a string with flags based on the items properties.
+        Tracks of an album usually share the same properties, so the result is
+        cached on the values of the fields used by the flags.
+        """
+        key = self._flag_cache_values(item)
+        if key not in self._flag_cache:
+            self._flag_cache[key] = "".join(
+                [flag.generate(item) for flag in self._flags]
+            )
+        return self._flag_cache[key]
+
+    def _flag_cache_values(self, item):
+        attrs = self._get_cache_attrs(item)
+        fields = (item.get(f) for f in self._cache_fields)
+        return attrs, tuple(tuple(v) if isinstance(v, list) else v for v in fields)
 
     def commands(self):
         update_flags_command = ui.Subcommand("updateflags", help="update album flags")
@@ -174,69 +257,89 @@ class AlbumFlags(BeetsPlugin):
 
         return [update_flags_command, remove_flags_command]
 
-    def _update_flags(self, item, write=False, move=False):
-        # Reload the item as it could have changed due to us making changes to the parent album
-        item.load()
-
+    def _update_flags(self, item):
+        """Return the album string of the item with up to date flags"""
         self._log.debug("Updating flags for item: {0.id}: {0.title}", item)
 
-        album = self._remove_flag_string(item.album)
         flags = self._generate_flag_string(item)
-        album_with_flags = album + flags
 
         self._log.debug("Generated the following flags: {0}", flags)
 
-        if item.album != album_with_flags:
-            self._log.debug(
-                'Changing album from "{0}" to "{1}"', item.album, album_with_flags
-            )
-            item.album = album_with_flags
-            item.try_sync(write, move)
-
-        # Also write the changes to the parent album
-        current_album = item.get_album()
-        if current_album and current_album.album != album_with_flags:
-            current_album.album = album_with_flags
-            current_album.try_sync(write, move)
+        # When the album already ends with the flags and nothing else looks like
+        # a flag, strip them without running the removal regex
+        album = item.album[: len(item.album) - len(flags)]
+        if not item.album.endswith(flags) or "(" in album:
+            album = self._remove_flag_string(item.album)
 
-    def _remove_flags(self, item, write=False, move=False):
-        # Reload the item as it could have changed due to us making changes to the parent album
-        item.load()
+        return album + flags
 
+    def _remove_flags(self, item):
+        """Return the album string of the item without flags"""
         self._log.debug("Removing flags for item: {0.id}: {0.title}", item)
 
-        album_without_flags = self._remove_flag_string(item.album)
-
-        if item.album != album_without_flags:
-            self._log.debug(
-                'Changing album from "{0}" to "{1}"', item.album, album_without_flags
-            )
-            item.album = album_without_flags
-            item.try_sync(write, move)
-
-        # Also write the changes to the parent album
-        current_album = item.get_album()
-        if current_album and current_album.album != album_without_flags:
-            current_album.album = album_without_flags
-            current_album.try_sync(write, move)
+        return self._remove_flag_string(item.album)
+
+    def _set_album(self, obj, album, write, move):
+        """Change the album string of an item or album and sync it"""
+        if obj.album != album:
+            self._log.debug('Changing album from "{0}" to "{1}"', obj.album, album)
+            obj.album = album
+            obj.try_sync(write, move)
+
+    def _sync_albums(self, items, func, write=False, move=False):
+        """Set the album string returned by func on every item. Items are
+        grouped by album and each album is synced once, which writes every
+        track once instead of writing it for itself and again for its album.
+        Nothing is written before all tracks of an album have been processed,
+        so the items don't need to be reloaded from the library.
+        """
+
+        def album_id(item):
+            # Singletons have no album id, group them together as they have no
+            # parent album to sync
+            return item.album_id or 0
+
+        for _, album_items in groupby(sorted(items, key=album_id), key=album_id):
+            album_items = list(album_items)
+            album_strings = [func(item) for item in album_items]
+
+            current_album = album_items[-1].get_album()
+            if not current_album:
+                for item, album in zip(album_items, album_strings):
+                    self._set_album(item, album, write, move)
+                continue
+
+            # All tracks of the album share the album string of the last one.
+            # Syncing a changed album passes it on to all of its tracks, else
+            # only the tracks that differ from the album need to be synced.
+            last_album = album_strings[-1]
+            if current_album.album != last_album:
+                self._set_album(current_album, last_album, write, move)
+            else:
+                for item in album_items:
+                    self._set_album(item, last_album, write, move)
 
     def _update_flags_command(self, lib, opts, args):
         query = ui.decargs(args)
         items, albums = _do_query(lib, query, opts.album, False)
 
-        for item in items:
-            self._update_flags(item, ui.should_write(), ui.should_move())
+        write, move = ui.should_write(), ui.should_move()
+
+        self._flag_cache.clear()
+        self._sync_albums(items, self._update_flags, write, move)
 
     def _remove_flags_command(self, lib, opts, args):
         query = ui.decargs(args)
         items, albums = _do_query(lib, query, opts.album, False)
 
-        for item in items:
-            self._remove_flags(item, ui.should_write(), ui.should_move())
+        write, move = ui.should_write(), ui.should_move()
+
+        self._sync_albums(items, self._remove_flags, write, move)
 
     def _import_stage(self, session, task):
         self._log.debug(
             "Running albumflags import task for {0}", displayable_path(task.paths)
         )
-        for item in task.imported_items():
-            self._update_flags(item)
+        self._flag_cache.clear()
+        # The importer writes and moves the files itself
+        self._sync_albums(task.imported_items(), self._update_flags, False, False)
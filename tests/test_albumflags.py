@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+
+from beets import config
+from beets.library import Item, Library
+
+from beetsplug.albumflags import AlbumFlags
+
+
+class SyncAlbumsTest(unittest.TestCase):
+    def setUp(self):
+        config.clear()
+        config.read(user=False, defaults=True)
+        config["albumflags"]["flags"] = ["bitdepth"]
+
+        self.lib = Library(":memory:")
+        self.plugin = AlbumFlags()
+
+    def tearDown(self):
+        config.clear()
+
+    def _item(self, album, bitdepth):
+        return Item(album=album, title="track", bitdepth=bitdepth, path=b"/x.flac")
+
+    def _add_album(self, album, bitdepths):
+        return self.lib.add_album([self._item(album, b) for b in bitdepths])
+
+    def _sync(self, func):
+        """Sync all items with func and return the number of files written"""
+        with mock.patch.object(Item, "try_write") as try_write:
+            self.plugin._sync_albums(self.lib.items(), func, write=True)
+        return try_write.call_count
+
+    def _assert_album(self, album, album_string):
+        album.load()
+        self.assertEqual(album.album, album_string)
+        for item in album.items():
+            self.assertEqual(item.album, album_string)
+
+    def test_update_writes_each_track_once(self):
+        big = self._add_album("Big", [24] * 10)
+        small = self._add_album("Small (24bit)", [16] * 3)
+
+        self.assertEqual(self._sync(self.plugin._update_flags), 13)
+        self._assert_album(big, "Big (24bit)")
+        self._assert_album(small, "Small")
+
+    def test_remove_writes_each_track_once(self):
+        big = self._add_album("Big (24bit)", [24] * 10)
+
+        self.assertEqual(self._sync(self.plugin._remove_flags), 10)
+        self._assert_album(big, "Big")
+
+    def test_up_to_date_album_is_not_written(self):
+        self._add_album("Same (24bit)", [24] * 3)
+
+        self.assertEqual(self._sync(self.plugin._update_flags), 0)
+
+    def test_tracks_follow_last_track(self):
+        album = self._add_album("Mixed (24bit)", [24, 16, 24])
+        first = album.items().get()
+        first.album = "Mixed"
+        first.store()
+
+        self.assertEqual(self._sync(self.plugin._update_flags), 1)
+        self._assert_album(album, "Mixed (24bit)")
+
+    def test_singleton_is_written(self):
+        item_id = self.lib.add(self._item("Single", 24))
+
+        self.assertEqual(self._sync(self.plugin._update_flags), 1)
+        self.assertEqual(self.lib.get_item(item_id).album, "Single (24bit)")
+
+
+if __name__ == "__main__":
+    unittest.main()